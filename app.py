@@ -1,10 +1,28 @@
 # --- START OF FILE app.py ---
 
 import re
+import os
+import gzip
+import time
+import random
+import cProfile
+import functools
+import uuid
+import sqlite3
+import socket
+import hashlib
+import threading
 import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 # MODIFIED: Removed OpenAI, added Google GenAI
-import google.generativeai as genai
+from google.ai import generativelanguage as glm
+from google.api_core import client_options as client_options_lib
+from google.api_core import exceptions as google_exceptions
 import json
+from collections import defaultdict, deque
+from concurrent.futures import Future, wait
+from contextlib import contextmanager
+from dataclasses import dataclass, field
 from datetime import datetime
 import io
 import PyPDF2
@@ -147,11 +165,43 @@ GENRES = {
     }
 }
 
+# ------------------------  Chapter Length Profiles  ---------------------------
+# Token limits leave headroom above the word target (roughly 1.4 tokens per word
+# plus the closing choices) so that chapters are rarely cut off mid-reply.
+LENGTH_PROFILES = {
+    "⚡ Quick": {
+        "description": "Short, punchy chapters for faster turns.",
+        "words": "350–450",
+        "paragraphs": "~3–4",
+        "max_output_tokens": 1024,
+        "max_continuations": 1
+    },
+    "📖 Standard": {
+        "description": "Full, richly detailed chapters.",
+        "words": "900–1100",
+        "paragraphs": "~6–8",
+        "max_output_tokens": 2048,
+        "max_continuations": 2
+    },
+    "🐉 Epic": {
+        "description": "Long, novel-like chapters for immersive sessions.",
+        "words": "1500–1800",
+        "paragraphs": "~10–12",
+        "max_output_tokens": 3072,
+        "max_continuations": 2
+    }
+}
+DEFAULT_LENGTH_PROFILE = "📖 Standard"
+
+# Chapters report health and inventory changes in a tag that the state engine strips and applies
+STATE_TAG_RULE = "After the choices, add one final line listing only what changed this chapter, e.g. [STATE: health -10; gained Rope; lost Torch], or [STATE: none] if nothing changed."
+
 
 # ------------------------  Enhanced System Prompts  ---------------------------
 # (No changes needed in this section, these prompts work well with Gemini)
-def get_standard_system_prompt(character, story_type, genre_info, backstory=""):
+def get_standard_system_prompt(character, story_type, genre_info, backstory="", length_profile=DEFAULT_LENGTH_PROFILE):
     backstory_context = f"\n\nCharacter Backstory: {backstory}" if backstory else ""
+    length = LENGTH_PROFILES[length_profile]
     
     return f"""You are a master interactive fiction storyteller creating an immersive {story_type} adventure.
 
@@ -163,7 +213,7 @@ STORY STYLE: {genre_info['story_style']}
 
 CRITICAL STORYTELLING RULES:
 1. **Always write in SECOND PERSON** ("You approach the castle..." not "The character approaches...")
-2. **Write a full chapter of 900–1100 words** (~6–8 detailed paragraphs) with vivid sensory details. Each chapter should be a complete richly developed scene.
+2. **Write a full chapter of {length['words']} words** ({length['paragraphs']} detailed paragraphs) with vivid sensory details. Each chapter should be a complete richly developed scene.
 3. **GENRE INFLUENCE**: Maintain the {genre_info['tone']} tone throughout. {genre_info['story_style']}
 4. **Use Markdown formatting**:
    - **Bold** for emphasis, important items, or dramatic moments
@@ -180,13 +230,15 @@ CRITICAL STORYTELLING RULES:
 9. **Reference inventory and character background** when relevant to the genre
 10. **Create memorable NPCs** with distinct personalities that fit the genre tone
 11. **Build tension and pacing** appropriate to the genre - vary between action, exploration, and character moments
+12. **Track game state**: {STATE_TAG_RULE}
 
 Setting: {story_type}
 Current Chapter: Continue the adventure maintaining narrative flow, character consistency, and genre atmosphere.
 """
 
-def get_custom_system_prompt(character, custom_setting, genre_info, backstory=""):
+def get_custom_system_prompt(character, custom_setting, genre_info, backstory="", length_profile=DEFAULT_LENGTH_PROFILE):
     backstory_context = f"\n\nCharacter Backstory: {backstory}" if backstory else ""
+    length = LENGTH_PROFILES[length_profile]
     
     return f"""You are an expert interactive fiction storyteller adapting to a custom world setting.
 
@@ -201,7 +253,7 @@ STORY STYLE: {genre_info['story_style']}
 
 CRITICAL STORYTELLING RULES:
 1. **Always write in SECOND PERSON** ("You step into..." not "The character steps...")
-2. **Write a full chapter of 900–1100 words** (~6–8 detailed paragraphs) with vivid sensory details. This must be a longer, richly developed scene.
+2. **Write a full chapter of {length['words']} words** ({length['paragraphs']} detailed paragraphs) with vivid sensory details. This must be a richly developed scene.
 3. **GENRE INFLUENCE**: Maintain the {genre_info['tone']} tone and incorporate {genre_info['themes']} themes. {genre_info['story_style']}
 4. **Use Markdown formatting**:
    - **Bold** for emphasis, important elements, or dramatic moments
@@ -217,6 +269,7 @@ CRITICAL STORYTELLING RULES:
 9. **Create meaningful consequences** for player decisions that reflect genre themes
 10. **Reference character background** and how it fits in this custom world and genre
 11. **Build immersive scenes** that feel authentic to both the provided setting and chosen genre
+12. **Track game state**: {STATE_TAG_RULE}
 
 Current Chapter: Continue the adventure within this custom world, maintaining its unique flavor, rules, and the chosen genre atmosphere.
 """
@@ -244,9 +297,9 @@ def extract_text_from_txt(txt_file) -> str:
         return ""
 
 # ------------------------  Session State Management  -------------------------
-def initialize_session_state():
-    """Initialize all session state variables"""
-    defaults = {
+def session_defaults() -> dict:
+    """Fresh default values for every game state variable"""
+    return {
         "messages": [],
         "character_created": False,
         "character": {},
@@ -265,14 +318,18 @@ def initialize_session_state():
         "session_summaries": [],
         "adventure_mode": "",
         "custom_input_value": "",
+        "pending_move": None,
+        "length_profile": DEFAULT_LENGTH_PROFILE,
+        "adventure_id": "",
         "gemini_model": None # NEW: Add a key for the Gemini model
     }
-    for key, value in defaults.items():
+
+def initialize_session_state():
+    """Initialize all session state variables"""
+    for key, value in session_defaults().items():
         if key not in st.session_state:
             st.session_state[key] = value
 
-initialize_session_state()
-
 
 # ------------------------  UI Sections (Character, Genre, Story)  -------------
 # (No changes are needed in any of the UI or selector functions)
@@ -441,6 +498,14 @@ def genre_selection():
 def adventure_mode_selection():
     st.markdown('<div class="chapter-title">🗺️ Choose Adventure Mode</div>', unsafe_allow_html=True)
     st.info(f"🎭 Selected Genre: **{st.session_state.selected_genre}** - {GENRES[st.session_state.selected_genre]['description']}")
+    profile_names = list(LENGTH_PROFILES)
+    st.session_state.length_profile = st.radio(
+        "📏 Chapter Length:",
+        profile_names,
+        index=profile_names.index(st.session_state.length_profile),
+        horizontal=True,
+        help=" ".join(f"{name}: {profile['description']}" for name, profile in LENGTH_PROFILES.items())
+    )
     col1, col2 = st.columns(2)
     with col1:
         st.markdown("### 🏰 Standard Adventures")
@@ -541,6 +606,530 @@ def get_genre_example(genre):
     return examples.get(genre, "A unique world of your imagination...")
 
 
+# ---------------------------  Model Backend  ---------------------------------
+# Every Gemini request goes through generate_content() so that traffic can be
+# recorded to (or replayed from) a cassette file for offline benchmarking.
+CHAPTER_MODEL = "gemini-1.5-pro"
+SUMMARY_MODEL = "gemini-1.5-flash-latest"
+
+
+@dataclass
+class ModelReply:
+    text: str
+    finish_reason: str = "STOP"
+    latency: float = 0.0
+
+
+def get_setting(name, default=None):
+    """Read a deployment setting from the environment, falling back to Streamlit secrets"""
+    if name in os.environ:
+        return os.environ[name]
+    try:
+        return st.secrets.get(name, default)
+    except FileNotFoundError:
+        return default
+
+
+def build_model_spec(model_name, system_instruction=None, generation_config=None) -> dict:
+    """Describe a model configuration as plain data (kept in session state and cassettes)"""
+    return {
+        "model_name": model_name,
+        "system_instruction": system_instruction,
+        "generation_config": generation_config or {},
+    }
+
+
+# API keys are pooled so one project's quota does not cap the whole deployment.
+# Configure GOOGLE_API_KEYS in secrets as a list of keys, or of tables such as
+# {key = "...", weight = 2, endpoint = "http://localhost:8765"}; GOOGLE_API_KEY
+# alone still works. GEMINI_API_ENDPOINT overrides the endpoint for every key.
+class NoHealthyKeyError(RuntimeError):
+    """Raised when every API key in the pool is quarantined"""
+
+
+@dataclass
+class PooledKey:
+    api_key: str
+    weight: float = 1.0
+    endpoint: Optional[str] = None
+    in_flight: int = 0
+    requests: int = 0
+    failures: int = 0
+    quarantined_until: float = 0.0
+    probing: bool = False
+    last_error: str = ""
+    recent: deque = field(default_factory=deque)
+    client: object = None
+
+    @property
+    def label(self) -> str:
+        return f"…{self.api_key[-4:]}"
+
+
+def classify_key_error(error) -> Optional[str]:
+    """Return "auth" or "quota" if an error means the key itself should be rested"""
+    # The REST transport raises Unauthorized/Forbidden where gRPC raises Unauthenticated/PermissionDenied
+    auth_errors = (google_exceptions.Unauthenticated, google_exceptions.PermissionDenied, google_exceptions.Unauthorized, google_exceptions.Forbidden)
+    if isinstance(error, auth_errors) or "API_KEY" in str(error):
+        return "auth"
+    if isinstance(error, (google_exceptions.ResourceExhausted, google_exceptions.TooManyRequests)) or "quota" in str(error).lower():
+        return "quota"
+    return None
+
+
+class KeyPool:
+    """Thread-safe pool of API keys with weighted least-loaded selection and quarantine.
+
+    A key that fails with an auth or quota error is quarantined with exponential
+    backoff. Once the quarantine expires, the next request routed to it acts as a
+    recovery probe: no other request uses the key until the probe succeeds.
+    """
+
+    AUTH_QUARANTINE = 600.0
+    QUOTA_QUARANTINE = 30.0
+    MAX_QUARANTINE = 1800.0
+
+    def __init__(self, keys):
+        self.keys = keys
+        self._lock = threading.Lock()
+
+    def acquire(self) -> PooledKey:
+        now = time.monotonic()
+        with self._lock:
+            candidates = []
+            for key in self.keys:
+                while key.recent and now - key.recent[0] > 60:
+                    key.recent.popleft()
+                if key.probing or key.quarantined_until > now:
+                    continue
+                candidates.append(key)
+            if not candidates:
+                raise NoHealthyKeyError("All Google API keys are quarantined after auth or quota errors. Try again shortly.")
+            chosen = min(candidates, key=lambda k: (k.in_flight + len(k.recent)) / k.weight)
+            chosen.probing = chosen.quarantined_until > 0
+            chosen.in_flight += 1
+            chosen.requests += 1
+            chosen.recent.append(now)
+        return chosen
+
+    def release(self, key, error=None):
+        with self._lock:
+            key.in_flight -= 1
+            key.probing = False
+            if error is None:
+                key.failures = 0
+                key.quarantined_until = 0.0
+                key.last_error = ""
+                return
+            kind = classify_key_error(error)
+            if kind is None:
+                return
+            key.failures += 1
+            base = self.AUTH_QUARANTINE if kind == "auth" else self.QUOTA_QUARANTINE
+            key.quarantined_until = time.monotonic() + min(base * 2 ** (key.failures - 1), self.MAX_QUARANTINE)
+            key.last_error = f"{kind}: {error}"[:200]
+
+    def in_flight(self) -> int:
+        with self._lock:
+            return sum(key.in_flight for key in self.keys)
+
+    def stats(self) -> list:
+        now = time.monotonic()
+        with self._lock:
+            rows = []
+            for key in self.keys:
+                if key.probing:
+                    status = "probing"
+                elif key.quarantined_until > now:
+                    status = f"quarantined {key.quarantined_until - now:.0f}s"
+                else:
+                    status = "healthy"
+                rows.append({
+                    "key": key.label,
+                    "status": status,
+                    "weight": key.weight,
+                    "in_flight": key.in_flight,
+                    "requests_last_minute": sum(1 for t in key.recent if now - t <= 60),
+                    "requests": key.requests,
+                    "last_error": key.last_error,
+                })
+            return rows
+
+
+@st.cache_resource
+def get_key_pool() -> KeyPool:
+    """Shared key pool for all sessions in this process"""
+    entries = get_setting("GOOGLE_API_KEYS")
+    if isinstance(entries, str):
+        entries = [entry.strip() for entry in entries.split(",") if entry.strip()]
+    if not entries:
+        single_key = get_setting("GOOGLE_API_KEY")
+        entries = [single_key] if single_key else []
+    default_endpoint = get_setting("GEMINI_API_ENDPOINT")
+    keys = []
+    for entry in entries:
+        if isinstance(entry, str):
+            entry = {"key": entry}
+        endpoint = entry.get("endpoint", default_endpoint)
+        options = client_options_lib.ClientOptions(api_key=entry["key"], api_endpoint=endpoint)
+        keys.append(PooledKey(
+            api_key=entry["key"],
+            weight=float(entry.get("weight", 1.0)),
+            endpoint=endpoint,
+            client=glm.GenerativeServiceClient(client_options=options, transport="rest" if endpoint else None),
+        ))
+    return KeyPool(keys)
+
+
+def build_generate_request(spec, contents) -> glm.GenerateContentRequest:
+    """Convert a model spec and Gemini-style history into an API request"""
+    request = {
+        "model": f"models/{spec['model_name']}",
+        "contents": [
+            glm.Content(role=turn["role"], parts=[glm.Part(text=text) for text in turn["parts"]])
+            for turn in contents
+        ],
+        "generation_config": glm.GenerationConfig(**spec["generation_config"]),
+    }
+    if spec["system_instruction"]:
+        request["system_instruction"] = glm.Content(parts=[glm.Part(text=spec["system_instruction"])])
+    return glm.GenerateContentRequest(**request)
+
+
+def _live_generate(spec, contents) -> ModelReply:
+    """Send a request to the real Gemini API through the pooled key's own client"""
+    pool = get_key_pool()
+    key = pool.acquire()
+    try:
+        response = key.client.generate_content(request=build_generate_request(spec, contents))
+    except Exception as e:
+        pool.release(key, e)
+        raise
+    pool.release(key)
+    if not response.candidates:
+        raise ValueError(f"Gemini returned no candidates (block reason: {response.prompt_feedback.block_reason.name})")
+    candidate = response.candidates[0]
+    text = "".join(part.text for part in candidate.content.parts)
+    if not text:
+        raise ValueError(f"Gemini returned an empty reply (finish reason: {candidate.finish_reason.name})")
+    return ModelReply(text=text, finish_reason=candidate.finish_reason.name)
+
+
+class CassetteMismatchError(RuntimeError):
+    """Raised in replay mode when a request has no matching recorded interaction"""
+
+
+def _first_difference(recorded, actual, width=40) -> str:
+    """Show where two strings diverge"""
+    recorded, actual = str(recorded), str(actual)
+    index = next((i for i, (a, b) in enumerate(zip(recorded, actual)) if a != b), min(len(recorded), len(actual)))
+    return f"at char {index}: recorded {recorded[index:index + width]!r} vs actual {actual[index:index + width]!r}"
+
+
+def _request_differences(recorded, actual) -> list:
+    """List the fields in which an actual request differs from a recorded one"""
+    differences = []
+    for field in ("model_name", "system_instruction", "generation_config"):
+        if recorded["model"].get(field) != actual["model"].get(field):
+            differences.append(f"{field} {_first_difference(recorded['model'].get(field), actual['model'].get(field))}")
+    recorded_turns, actual_turns = recorded["contents"], actual["contents"]
+    if len(recorded_turns) != len(actual_turns):
+        differences.append(f"history length (recorded {len(recorded_turns)} turns, actual {len(actual_turns)})")
+    for index, (a, b) in enumerate(zip(recorded_turns, actual_turns)):
+        if a != b:
+            differences.append(f"turn {index} ({b['role']}) {_first_difference(''.join(a['parts']), ''.join(b['parts']))}")
+            break
+    return differences
+
+
+class Cassette:
+    """Records model traffic to a JSON-lines file, or serves it back in replay mode"""
+
+    def __init__(self, path, mode, latency_scale=1.0):
+        self.path = path
+        self.mode = mode
+        self.latency_scale = latency_scale
+        self.mismatches = []
+        self.replayed = 0
+        self._lock = threading.Lock()
+        self._recordings = []
+        self._pending = defaultdict(deque)
+        if mode == "replay":
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        interaction = json.loads(line)
+                        self._recordings.append(interaction)
+                        self._pending[interaction["fingerprint"]].append(interaction)
+
+    @staticmethod
+    def fingerprint(kind, request) -> str:
+        payload = json.dumps({"kind": kind, "request": request}, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def record(self, kind, request, reply):
+        interaction = {
+            "fingerprint": self.fingerprint(kind, request),
+            "kind": kind,
+            "recorded_at": datetime.now().isoformat(timespec="seconds"),
+            "latency": round(reply.latency, 4),
+            "request": request,
+            "response": {"text": reply.text, "finish_reason": reply.finish_reason},
+        }
+        line = json.dumps(interaction, ensure_ascii=False)
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+
+    def replay(self, kind, request) -> ModelReply:
+        fingerprint = self.fingerprint(kind, request)
+        with self._lock:
+            queue = self._pending.get(fingerprint)
+            interaction = queue.popleft() if queue else None
+            if interaction is None:
+                message = self._describe_mismatch(kind, request, fingerprint)
+                self.mismatches.append(message)
+            else:
+                self.replayed += 1
+        if interaction is None:
+            raise CassetteMismatchError(message)
+        time.sleep(interaction["latency"] * self.latency_scale)
+        response = interaction["response"]
+        return ModelReply(text=response["text"], finish_reason=response["finish_reason"])
+
+    def _describe_mismatch(self, kind, request, fingerprint) -> str:
+        same_kind = [i for i in self._recordings if i["kind"] == kind]
+        if not same_kind:
+            return f"Cassette {self.path} has no recorded '{kind}' requests."
+        if any(i["fingerprint"] == fingerprint for i in same_kind):
+            return f"Cassette {self.path}: this '{kind}' request was recorded, but every recorded copy has already been replayed."
+        closest = min(same_kind, key=lambda i: len(_request_differences(i["request"], request)))
+        differences = "; ".join(_request_differences(closest["request"], request))
+        return f"Cassette {self.path}: unrecorded '{kind}' request. Closest recording ({closest['recorded_at']}) differs in {differences}"
+
+    def report(self) -> dict:
+        """Summarize replay progress and any mismatches"""
+        with self._lock:
+            return {
+                "mode": self.mode,
+                "recorded": len(self._recordings),
+                "replayed": self.replayed,
+                "unplayed": sum(len(queue) for queue in self._pending.values()),
+                "mismatches": list(self.mismatches),
+            }
+
+
+@st.cache_resource
+def get_cassette() -> Optional[Cassette]:
+    """Shared cassette for all sessions, when LOREWEAVER_CASSETTE_MODE is record or replay"""
+    mode = str(get_setting("LOREWEAVER_CASSETTE_MODE", "off")).lower()
+    if mode not in ("record", "replay"):
+        return None
+    path = get_setting("LOREWEAVER_CASSETTE_PATH", "cassettes/loreweaver.jsonl")
+    if mode == "record":
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    latency_scale = float(get_setting("LOREWEAVER_REPLAY_LATENCY_SCALE", 1.0))
+    return Cassette(path, mode, latency_scale)
+
+
+def is_replaying() -> bool:
+    cassette = get_cassette()
+    return cassette is not None and cassette.mode == "replay"
+
+
+def generate_content(spec, contents, kind) -> ModelReply:
+    """Send one request to Gemini, recording or replaying it when a cassette is active"""
+    cassette = get_cassette()
+    request = {"model": spec, "contents": contents}
+    start = time.perf_counter()
+    if is_replaying():
+        reply = cassette.replay(kind, request)
+    else:
+        reply = _live_generate(spec, contents)
+    reply.latency = time.perf_counter() - start
+    if cassette is not None and cassette.mode == "record":
+        cassette.record(kind, request, reply)
+    return reply
+
+
+# Gemini reports MAX_TOKENS when a reply hits max_output_tokens; such chapters are
+# continued and stitched so the numbered choices are never lost. The cut-off
+# reply is first trimmed back to its last whitespace, so the continuation always
+# starts on a word boundary and the join does not depend on the model's spacing.
+CONTINUATION_PROMPT = "Your previous reply was cut off. Continue it exactly where it stopped, starting with the next word, without repeating any text, and finish the chapter with the numbered choices."
+
+
+def trim_partial_word(text) -> str:
+    """Drop the possibly unfinished last word of a truncated reply, keeping the whitespace before it"""
+    match = re.match(r"(.*\s)\S*$", text, re.DOTALL)
+    return match.group(1) if match else text
+
+
+def stitch_reply(head, tail) -> str:
+    """Join a reply trimmed by trim_partial_word() with its continuation, dropping any text the model repeated"""
+    if head[-1:].isspace():
+        tail = tail.lstrip(" \t")
+    for size in range(min(len(head), len(tail), 200), 15, -1):
+        if head.endswith(tail[:size]):
+            tail = tail[size:]
+            break
+    return head + tail
+
+
+def generate_chapter(spec, contents, kind, max_continuations=2) -> ModelReply:
+    """Generate a chapter, automatically continuing it if the reply was truncated"""
+    reply = generate_content(spec, contents, kind)
+    for _ in range(max_continuations):
+        if reply.finish_reason != "MAX_TOKENS":
+            break
+        head = trim_partial_word(reply.text)
+        follow_up = contents + [
+            {"role": "model", "parts": [head]},
+            {"role": "user", "parts": [CONTINUATION_PROMPT]},
+        ]
+        continuation = generate_content(spec, follow_up, kind="continuation")
+        reply = ModelReply(
+            text=stitch_reply(head, continuation.text),
+            finish_reason=continuation.finish_reason,
+            latency=reply.latency + continuation.latency,
+        )
+    return reply
+
+
+# ------------------------  Warm Opening Pool  --------------------------------
+# Opening chapters for standard (genre x adventure x length) combinations are
+# pre-generated in the background while traffic is quiet, so starting a standard
+# adventure can skip the slowest model call. Openings are class-agnostic and each
+# one is served to a single player. Disabled unless LOREWEAVER_WARM_POOL_SIZE > 0.
+WARM_OPENING_CHARACTER = {"name": "The traveler", "class": "adventurer", "background": "unknown"}
+
+
+def get_warm_opening_prompt(genre, story) -> str:
+    genre_info = GENRES[genre]
+    return f"""
+            A traveler begins their {genre} adventure in {story}.
+            
+            Set the opening scene with rich atmospheric detail that fits the {genre_info['tone']} tone, 
+            incorporating {genre_info['themes']} themes, and provide the first set of choices.
+            Do not name the protagonist or mention their profession, background or belongings; address them only as "you".
+            Remember to write in second person and create an immersive experience that matches the genre.
+            """
+
+
+class WarmPool:
+    """Background-filled pool of ready-made opening chapters"""
+
+    def __init__(self, size, budget_per_hour, quiet_in_flight, interval):
+        self.size = size
+        self.budget_per_hour = budget_per_hour
+        self.quiet_in_flight = quiet_in_flight
+        self.interval = interval
+        self.served = 0
+        self.misses = 0
+        self.generated = 0
+        self.last_error = ""
+        self._lock = threading.Lock()
+        self._openings = defaultdict(deque)
+        self._demand = defaultdict(int)
+        self._spent = deque()
+
+    @property
+    def enabled(self) -> bool:
+        return self.size > 0
+
+    def start(self):
+        threading.Thread(target=self._fill_forever, name="warm-pool-filler", daemon=True).start()
+
+    def take(self, genre, story, length_profile) -> Optional[str]:
+        """Remove and return a ready opening, if one is available"""
+        if not self.enabled:
+            return None
+        key = (genre, story, length_profile)
+        with self._lock:
+            self._demand[key] += 1
+            if self._openings[key]:
+                self.served += 1
+                return self._openings[key].popleft()
+            self.misses += 1
+            return None
+
+    def _budget_left(self) -> bool:
+        now = time.monotonic()
+        while self._spent and now - self._spent[0] > 3600:
+            self._spent.popleft()
+        return len(self._spent) < self.budget_per_hour
+
+    def _next_key(self):
+        """Pick the combination most worth filling: most requested first, then the default length"""
+        keys = [
+            (genre, story, length_profile)
+            for genre in GENRES
+            for story in get_genre_adapted_adventures(genre)
+            for length_profile in LENGTH_PROFILES
+        ]
+        keys = [key for key in keys if len(self._openings[key]) < self.size]
+        if not keys:
+            return None
+        return min(keys, key=lambda k: (len(self._openings[k]), -self._demand[k], k[2] != DEFAULT_LENGTH_PROFILE))
+
+    def fill_once(self) -> bool:
+        """Generate one opening if traffic is quiet and the budget allows"""
+        if get_key_pool().in_flight() > self.quiet_in_flight:
+            return False
+        with self._lock:
+            key = self._next_key() if self._budget_left() else None
+            if key is None:
+                return False
+            self._spent.append(time.monotonic())
+        genre, story, length_profile = key
+        profile = LENGTH_PROFILES[length_profile]
+        system_prompt = get_standard_system_prompt(WARM_OPENING_CHARACTER, story, GENRES[genre], length_profile=length_profile)
+        spec = build_model_spec(CHAPTER_MODEL, system_prompt, {"temperature": 0.8, "max_output_tokens": profile["max_output_tokens"]})
+        contents = [{"role": "user", "parts": [get_warm_opening_prompt(genre, story)]}]
+        reply = generate_chapter(spec, contents, "warm_opening", profile["max_continuations"])
+        with self._lock:
+            self._openings[key].append(reply.text)
+            self.generated += 1
+        return True
+
+    def _fill_forever(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.fill_once()
+            except Exception as e:
+                self.last_error = f"{type(e).__name__}: {e}"[:200]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "ready": sum(len(queue) for queue in self._openings.values()),
+                "served": self.served,
+                "misses": self.misses,
+                "generated": self.generated,
+                "budget_used_last_hour": len(self._spent),
+                "budget_per_hour": self.budget_per_hour,
+                "last_error": self.last_error,
+            }
+
+
+@st.cache_resource
+def get_warm_pool() -> WarmPool:
+    """Shared warm pool; the filler thread is only started when the pool is enabled"""
+    pool = WarmPool(
+        size=int(get_setting("LOREWEAVER_WARM_POOL_SIZE", 0)),
+        budget_per_hour=int(get_setting("LOREWEAVER_WARM_POOL_BUDGET_PER_HOUR", 30)),
+        quiet_in_flight=int(get_setting("LOREWEAVER_WARM_POOL_QUIET_IN_FLIGHT", 1)),
+        interval=float(get_setting("LOREWEAVER_WARM_POOL_INTERVAL", 5.0)),
+    )
+    # Cassette runs must stay deterministic, so background generation is off while one is active
+    if get_cassette() is not None:
+        pool.size = 0
+    if pool.enabled:
+        pool.start()
+    return pool
+
+
 # ------------------------  Adventure Initialization  -------------------------
 # MODIFIED: This function is completely rewritten for Gemini
 def initialize_adventure():
@@ -557,7 +1146,7 @@ def initialize_adventure():
         
         # 1. Get the correct system prompt
         if st.session_state.is_custom_adventure:
-            system_prompt = get_custom_system_prompt(character, st.session_state.custom_world, genre_info, backstory)
+            system_prompt = get_custom_system_prompt(character, st.session_state.custom_world, genre_info, backstory, st.session_state.length_profile)
             initial_user_prompt = f"""
             {character['name']} the {character['class']} (background: {character['background']}) 
             begins their {st.session_state.selected_genre} adventure in this custom world. They carry their {character['starting_item']}.
@@ -567,7 +1156,7 @@ def initialize_adventure():
             Remember to write in second person and provide rich, immersive descriptions that fit the genre.
             """
         else:
-            system_prompt = get_standard_system_prompt(character, st.session_state.selected_story, genre_info, backstory)
+            system_prompt = get_standard_system_prompt(character, st.session_state.selected_story, genre_info, backstory, st.session_state.length_profile)
             initial_user_prompt = f"""
             {character['name']} the {character['class']} (background: {character['background']}) 
             begins their {st.session_state.selected_genre} adventure in {st.session_state.selected_story}. They carry their {character['starting_item']}.
@@ -580,32 +1169,42 @@ def initialize_adventure():
         # 2. Configure Gemini and initialize the model with the system prompt
         st.write("🔧 Debug: Configuring Gemini...")
         
-        # Check if API key exists
-        if "GOOGLE_API_KEY" not in st.secrets:
-            st.error("❌ Google API key not found in secrets!")
-            return False
-            
-        api_key = st.secrets["GOOGLE_API_KEY"]
-        st.write(f"🔧 Debug: API key found (first 10 chars): {api_key[:10]}...")
-        
-        genai.configure(api_key=api_key)
+        # Check if API key exists (not needed when replaying a cassette)
+        if not is_replaying():
+            key_pool = get_key_pool()
+            if not key_pool.keys:
+                st.error("❌ Google API key not found in secrets!")
+                return False
+                
+            st.write(f"🔧 Debug: {len(key_pool.keys)} API key(s) in pool")
         
-        st.session_state.gemini_model = genai.GenerativeModel(
-            model_name="gemini-1.5-pro",
+        # The model is stored as a plain spec; generate_content() builds the client per request
+        st.session_state.gemini_model = build_model_spec(
+            CHAPTER_MODEL,
             system_instruction=system_prompt,
             generation_config={
                 "temperature": 0.8,
-                "max_output_tokens": 1500,
+                "max_output_tokens": LENGTH_PROFILES[st.session_state.length_profile]["max_output_tokens"],
             }
         )
         
         st.write("🔧 Debug: Gemini model created successfully")
         
+        st.session_state.adventure_id = uuid.uuid4().hex
+        index_adventure()
+        
         # 3. Set the initial message history (without the system prompt)
         st.session_state.messages = [
             {"role": "user", "content": initial_user_prompt}
         ]
         
+        # 4. Standard adventures without a personal backstory can start from a pre-generated opening
+        if not st.session_state.is_custom_adventure and not backstory:
+            opening = get_warm_pool().take(st.session_state.selected_genre, st.session_state.selected_story, st.session_state.length_profile)
+            if opening:
+                commit_chapter(initial_user_prompt, opening)
+                st.write("🔧 Debug: Using a pre-generated opening chapter")
+        
         st.write("🔧 Debug: Initial messages set")
         st.write(f"Messages: {len(st.session_state.messages)}")
         
@@ -617,6 +1216,170 @@ def initialize_adventure():
         import traceback
         st.error(f"❌ Traceback: {traceback.format_exc()}")
         return False
+
+def commit_chapter(user_move, reply_text) -> str:
+    """Record a finished chapter for the move already in messages: apply its state changes, store and index it"""
+    reply, delta = extract_state_delta(reply_text)
+    apply_state_delta(delta)
+    st.session_state.messages.append({"role": "assistant", "content": reply})
+    st.session_state.chapter_count += 1
+    st.session_state.game_history.append(user_move)
+    if st.session_state.chapter_count > 1:  # the first move is the hidden opening prompt
+        index_entry("choice", user_move)
+    index_entry("chapter", reply)
+    return reply
+
+
+# -----------------------------  Adventure Search Index  ----------------------
+# Committed chapters, choices and summaries are indexed incrementally in SQLite
+# FTS5, so players can search every saved adventure without loading transcripts.
+# Players are identified by a ?player=... token kept in the page URL.
+SEARCH_SCHEMA = """
+CREATE TABLE IF NOT EXISTS adventures (
+    adventure_id TEXT PRIMARY KEY,
+    player_id TEXT NOT NULL,
+    character_name TEXT,
+    genre TEXT,
+    story TEXT,
+    started_at TEXT
+);
+CREATE INDEX IF NOT EXISTS adventures_by_player ON adventures(player_id);
+CREATE VIRTUAL TABLE IF NOT EXISTS entries USING fts5(
+    content,
+    kind UNINDEXED,
+    chapter UNINDEXED,
+    adventure_id UNINDEXED,
+    player_id UNINDEXED,
+    tokenize = 'porter unicode61'
+);
+"""
+
+
+def to_fts_query(text) -> str:
+    """Turn free text into an FTS5 query: every word must match, the last one as a prefix"""
+    words = re.findall(r"\w+", text)
+    if not words:
+        return ""
+    quoted = ['"' + word.replace('"', '""') + '"' for word in words]
+    quoted[-1] += "*"
+    return " ".join(quoted)
+
+
+class SearchIndex:
+    """Full-text index of adventures behind one SQLite connection shared by all sessions
+
+    Streamlit runs every rerun on a fresh thread, so the connection is opened
+    with check_same_thread=False and every statement holds the lock.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(SEARCH_SCHEMA)
+
+    def add_adventure(self, adventure_id, player_id, character_name, genre, story):
+        with self._lock, self._conn as conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO adventures VALUES (?, ?, ?, ?, ?, ?)",
+                (adventure_id, player_id, character_name, genre, story, datetime.now().strftime("%Y-%m-%d %H:%M")),
+            )
+
+    def add_entry(self, adventure_id, player_id, kind, chapter, content):
+        with self._lock, self._conn as conn:
+            conn.execute(
+                "INSERT INTO entries (content, kind, chapter, adventure_id, player_id) VALUES (?, ?, ?, ?, ?)",
+                (content, kind, chapter, adventure_id, player_id),
+            )
+
+    def search(self, player_id, text, limit=20) -> list:
+        """Best-ranked matches for a player, with highlighted snippets"""
+        query = to_fts_query(text)
+        if not query:
+            return []
+        with self._lock:
+            rows = self._conn.execute(
+                """
+                SELECT entries.kind, entries.chapter, adventures.character_name, adventures.genre,
+                       adventures.story, adventures.started_at, snippet(entries, 0, '**', '**', '…', 16)
+                FROM entries JOIN adventures ON adventures.adventure_id = entries.adventure_id
+                WHERE entries MATCH ? AND entries.player_id = ?
+                ORDER BY bm25(entries)
+                LIMIT ?
+                """,
+                (query, player_id, limit),
+            ).fetchall()
+        keys = ("kind", "chapter", "character_name", "genre", "story", "started_at", "snippet")
+        return [dict(zip(keys, row)) for row in rows]
+
+
+@st.cache_resource
+def get_search_index() -> Optional[SearchIndex]:
+    """Shared search index, or None when disabled or SQLite lacks FTS5"""
+    path = get_setting("LOREWEAVER_SEARCH_DB", "data/adventures.db")
+    if not path:
+        return None
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    try:
+        return SearchIndex(path)
+    except sqlite3.OperationalError:
+        return None
+
+
+def get_player_id() -> str:
+    """Stable player token kept in the page URL so saved adventures survive reloads"""
+    player_id = st.query_params.get("player")
+    if not player_id:
+        player_id = uuid.uuid4().hex
+        st.query_params["player"] = player_id
+    return player_id
+
+
+def index_adventure():
+    index = get_search_index()
+    if index is None:
+        return
+    try:
+        index.add_adventure(
+            st.session_state.adventure_id,
+            get_player_id(),
+            st.session_state.character.get("name", ""),
+            st.session_state.selected_genre,
+            st.session_state.selected_story,
+        )
+    except sqlite3.Error as e:
+        st.warning(f"Search index unavailable: {str(e)}")
+
+def index_entry(kind, content):
+    index = get_search_index()
+    if index is None or not st.session_state.adventure_id:
+        return
+    try:
+        index.add_entry(st.session_state.adventure_id, get_player_id(), kind, st.session_state.chapter_count, content)
+    except sqlite3.Error as e:
+        st.warning(f"Search index unavailable: {str(e)}")
+
+def render_search():
+    index = get_search_index()
+    if index is None:
+        return
+    st.markdown("### 🔍 Search Past Adventures")
+    query = st.text_input("Search chapters, choices and summaries:", key="search_query", placeholder="e.g., lighthouse")
+    if not query.strip():
+        return
+    try:
+        results = index.search(get_player_id(), query)
+    except sqlite3.Error as e:
+        st.warning(f"Search index unavailable: {str(e)}")
+        return
+    if not results:
+        st.caption("No matches found.")
+    for result in results:
+        st.markdown(f"**{result['character_name']} · {result['story']}** ({result['genre']}, {result['started_at']}) — {result['kind']} {result['chapter']}")
+        st.markdown(f"> {result['snippet']}")
+
+
 # -----------------------------  Enhanced Sidebar  ----------------------------
 # (No changes needed in this section)
 def render_sidebar():
@@ -636,6 +1399,7 @@ def render_sidebar():
             if st.session_state.story_selected:
                 st.markdown(f"**⚔️ Adventure:** {st.session_state.selected_story}")
                 st.markdown(f"**📖 Chapter:** {st.session_state.chapter_count}")
+                st.markdown(f"**📏 Length:** {st.session_state.length_profile}")
                 st.markdown(f"**❤️ Health:** {st.session_state.health}/100")
                 if st.session_state.inventory:
                     st.markdown("**🎒 Inventory:**")
@@ -651,6 +1415,371 @@ def render_sidebar():
             if st.session_state.session_summaries:
                 with st.expander("📚 Session Summaries"):
                     for i, summary in enumerate(st.session_state.session_summaries, 1): st.markdown(f"**Session {i}:** {summary}")
+        st.markdown("---")
+        render_search()
+        render_admin_panel()
+
+
+def is_admin() -> bool:
+    """Admin tools are shown when the page is opened with ?admin=<LOREWEAVER_ADMIN_TOKEN>"""
+    token = get_setting("LOREWEAVER_ADMIN_TOKEN")
+    return bool(token) and st.query_params.get("admin") == token
+
+def render_admin_panel():
+    if not is_admin():
+        return
+    st.markdown("---")
+    st.markdown("### 🛠️ Admin")
+    with st.expander("🔑 API Key Pool"):
+        for row in get_key_pool().stats():
+            st.markdown(f"**{row['key']}** · {row['status']} · weight {row['weight']} · {row['in_flight']} in flight · {row['requests_last_minute']} req/min · {row['requests']} total")
+            if row["last_error"]:
+                st.caption(row["last_error"])
+    warm_pool = get_warm_pool()
+    if warm_pool.enabled:
+        with st.expander("🔥 Warm Opening Pool"):
+            st.json(warm_pool.stats())
+    with st.expander("🎯 Turn Submission"):
+        st.json(get_turn_coordinator().stats())
+    with st.expander("📋 Summary Batching"):
+        st.json(get_summary_aggregator().stats())
+    with st.expander("💤 Session Hibernation"):
+        st.json(get_hibernator().stats())
+    with st.expander("⏱️ Profiler"):
+        render_profiler_controls()
+    cassette = get_cassette()
+    if cassette is not None:
+        with st.expander("📼 Cassette"):
+            st.json(cassette.report())
+
+
+# ---------------------------  Summary Batching  ------------------------------
+# Session summaries are small requests, so jobs arriving from different sessions
+# within a short window are sent to the (faster) summary model as one request
+# with numbered markers. If the reply cannot be parsed back cleanly, every job in
+# the batch falls back to its own request, and the window bounds the extra latency.
+# Markers may come wrapped in Markdown ("### SUMMARY 1", "**SUMMARY 2:**").
+SUMMARY_MARKER_PATTERN = re.compile(r"^[\s#*_>]*SUMMARY\s+(\d+)[\s:.*_]*$", re.MULTILINE | re.IGNORECASE)
+STRAY_SUMMARY_MARKER_PATTERN = re.compile(r"SUMMARY\s+\d+", re.IGNORECASE)
+
+
+def get_summary_prompt(story_content) -> str:
+    return f"""
+        Create a brief, engaging summary (2-3 sentences) of the recent adventure events:
+        
+        {story_content}
+        
+        Focus on key actions, discoveries, and character development. Write in past tense.
+        """
+
+
+def get_batched_summary_prompt(story_contents) -> str:
+    adventures = "\n\n".join(f"### ADVENTURE {i}\n{content}" for i, content in enumerate(story_contents, 1))
+    return f"""
+        Create a brief, engaging summary (2-3 sentences) of the recent events in each of the following {len(story_contents)} separate adventures.
+        Focus on key actions, discoveries, and character development. Write in past tense. Never mix events from different adventures.
+        
+        Reply with exactly {len(story_contents)} summaries, each introduced by its marker on a line of its own ("### SUMMARY 1", "### SUMMARY 2", ...), and nothing else.
+        
+        {adventures}
+        """
+
+
+def split_batched_summaries(text, count) -> dict:
+    """Map item numbers (1-based) to summaries found in a batched reply
+
+    Returns an empty dict unless every item appears exactly once with a clean body: a
+    marker the pattern missed would otherwise glue one adventure's summary onto another's.
+    """
+    parts = SUMMARY_MARKER_PATTERN.split(text)
+    summaries = {}
+    for number, body in zip(parts[1::2], parts[2::2]):
+        number = int(number)
+        body = body.strip()
+        if not 1 <= number <= count or not body or number in summaries or STRAY_SUMMARY_MARKER_PATTERN.search(body):
+            return {}
+        summaries[number] = body
+    if len(summaries) != count:
+        return {}
+    return summaries
+
+
+@dataclass
+class SummaryJob:
+    story_content: str
+    submitted: float
+    future: Future
+
+
+class SummaryAggregator:
+    """Collects summary jobs from all sessions and sends them in batches"""
+
+    def __init__(self, window, max_batch):
+        self.window = window
+        self.max_batch = max_batch
+        self.jobs = 0
+        self.requests = 0
+        self.batched_requests = 0
+        self.fallbacks = 0
+        self._cond = threading.Condition()
+        self._queue = deque()
+
+    def start(self):
+        threading.Thread(target=self._collect_forever, name="summary-batcher", daemon=True).start()
+
+    def summarize(self, story_content) -> str:
+        """Queue a summary job and wait for its result"""
+        if self.max_batch <= 1:
+            with self._cond:
+                self.jobs += 1
+            return self._summarize_one(story_content)
+        job = SummaryJob(story_content, time.monotonic(), Future())
+        with self._cond:
+            self.jobs += 1
+            self._queue.append(job)
+            self._cond.notify()
+        return job.future.result(timeout=self.window + 120)
+
+    def _collect_forever(self):
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                deadline = self._queue[0].submitted + self.window
+                while len(self._queue) < self.max_batch and time.monotonic() < deadline:
+                    self._cond.wait(deadline - time.monotonic())
+                batch = [self._queue.popleft() for _ in range(min(self.max_batch, len(self._queue)))]
+            threading.Thread(target=self._process, args=(batch,), daemon=True).start()
+
+    def _summarize_one(self, story_content) -> str:
+        spec = build_model_spec(SUMMARY_MODEL, generation_config={"temperature": 0.7, "max_output_tokens": 150})
+        with self._cond:
+            self.requests += 1
+        return generate_content(spec, [{"role": "user", "parts": [get_summary_prompt(story_content)]}], kind="summary").text
+
+    def _process(self, batch):
+        summaries = {}
+        if len(batch) > 1:
+            spec = build_model_spec(SUMMARY_MODEL, generation_config={"temperature": 0.7, "max_output_tokens": 200 * len(batch)})
+            prompt = get_batched_summary_prompt([job.story_content for job in batch])
+            with self._cond:
+                self.requests += 1
+                self.batched_requests += 1
+            try:
+                reply = generate_content(spec, [{"role": "user", "parts": [prompt]}], kind="summary_batch")
+                summaries = split_batched_summaries(reply.text, len(batch))
+            except Exception:
+                summaries = {}
+        for number, job in enumerate(batch, 1):
+            if number in summaries:
+                job.future.set_result(summaries[number])
+                continue
+            if len(batch) > 1:
+                with self._cond:
+                    self.fallbacks += 1
+            try:
+                job.future.set_result(self._summarize_one(job.story_content))
+            except Exception as e:
+                job.future.set_exception(e)
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "jobs": self.jobs,
+                "requests": self.requests,
+                "batched_requests": self.batched_requests,
+                "fallbacks": self.fallbacks,
+                "pending": len(self._queue),
+                "window_seconds": self.window,
+                "max_batch": self.max_batch,
+            }
+
+
+@st.cache_resource
+def get_summary_aggregator() -> SummaryAggregator:
+    aggregator = SummaryAggregator(
+        window=float(get_setting("LOREWEAVER_SUMMARY_BATCH_WINDOW", 0.5)),
+        max_batch=int(get_setting("LOREWEAVER_SUMMARY_BATCH_SIZE", 8)),
+    )
+    # Batch composition depends on timing, so cassette runs summarize one request at a time
+    if get_cassette() is not None:
+        aggregator.max_batch = 1
+    if aggregator.max_batch > 1:
+        aggregator.start()
+    return aggregator
+
+
+# ---------------------------  Session Hibernation  ---------------------------
+# Sessions idle for LOREWEAVER_HIBERNATE_AFTER seconds have their game state
+# written to a gzipped JSON snapshot and removed from memory. The next rerun of
+# that session restores it before anything else reads session state. Snapshot
+# names carry the host and process ID, so replicas can share the directory;
+# snapshots a dead process left behind are aged out by modification time.
+# Sessions Streamlit has closed are dropped along with their snapshots.
+class SessionHibernator:
+    """Tracks session activity and moves idle game state to disk"""
+
+    def __init__(self, directory, idle_seconds, interval, retention_seconds, turn_coordinator, session_exists):
+        self.directory = directory
+        self.idle_seconds = idle_seconds
+        self.interval = interval
+        self.retention_seconds = retention_seconds
+        self.turn_coordinator = turn_coordinator
+        self.session_exists = session_exists
+        self.hibernations = 0
+        self.rehydrations = 0
+        self.last_error = ""
+        self._prefix = f"{socket.gethostname()}-{os.getpid()}-"
+        self._lock = threading.Lock()
+        self._sessions = {}
+        self._hibernated = set()
+        self._restoring = {}
+
+    def _path(self, session_id) -> str:
+        return os.path.join(self.directory, f"{self._prefix}{session_id}.json.gz")
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.remove_expired_snapshots()
+        threading.Thread(target=self._reap_forever, name="session-reaper", daemon=True).start()
+
+    def remove_expired_snapshots(self):
+        """Delete snapshots of any process that are older than the retention period"""
+        cutoff = time.time() - self.retention_seconds
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".json.gz") and entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+
+    def touch(self, session_id, state) -> bool:
+        """Mark a session active, restoring its snapshot if it was hibernated"""
+        if self.idle_seconds <= 0:
+            return False
+        with self._lock:
+            self._sessions[session_id] = (state, time.monotonic())
+            restoring = self._restoring.get(session_id)
+            restore = restoring is None and session_id in self._hibernated
+            if restore:
+                self._hibernated.discard(session_id)
+                restoring = self._restoring[session_id] = threading.Event()
+        if not restore:
+            if restoring is not None:
+                # Another rerun of this session is already reading the snapshot
+                restoring.wait()
+            return False
+        try:
+            path = self._path(session_id)
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                snapshot = json.load(f)
+            # Button callbacks run before the script body, so keys set since hibernation are newer
+            for key, value in snapshot.items():
+                if key not in state:
+                    state[key] = value
+            os.remove(path)
+            with self._lock:
+                self.rehydrations += 1
+        finally:
+            with self._lock:
+                del self._restoring[session_id]
+            restoring.set()
+        return True
+
+    def hibernate_idle(self):
+        now = time.monotonic()
+        expired, closed, idle = [], [], []
+        with self._lock:
+            for session_id, (state, last_active) in list(self._sessions.items()):
+                if now - last_active > self.retention_seconds or not self.session_exists(session_id):
+                    # Streamlit has dropped this session, so its state can never be used again
+                    del self._sessions[session_id]
+                    if session_id in self._hibernated:
+                        self._hibernated.discard(session_id)
+                        expired.append(self._path(session_id))
+                    closed.append(session_id)
+                elif (now - last_active > self.idle_seconds and session_id not in self._hibernated
+                      and session_id not in self._restoring):
+                    idle.append((session_id, state, last_active))
+        for path in expired:
+            os.remove(path)
+        for session_id in closed:
+            self.turn_coordinator.forget(session_id)
+        for session_id, state, last_active in idle:
+            self._hibernate(session_id, state, last_active)
+
+    def _hibernate(self, session_id, state, last_active):
+        snapshot = {key: state[key] for key in session_defaults() if key in state}
+        path = self._path(session_id)
+        with gzip.open(path + ".tmp", "wt", encoding="utf-8") as f:
+            json.dump(snapshot, f, separators=(",", ":"), ensure_ascii=False)
+        with self._lock:
+            # Only drop the state if no rerun touched the session while the snapshot was written
+            still_idle = self._sessions.get(session_id, (None, None))[1] == last_active
+            if still_idle:
+                os.replace(path + ".tmp", path)
+                for key in snapshot:
+                    del state[key]
+                self._hibernated.add(session_id)
+                self.hibernations += 1
+        if not still_idle:
+            os.remove(path + ".tmp")
+            return
+        self.turn_coordinator.forget(session_id)
+
+    def _reap_forever(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.hibernate_idle()
+            except Exception as e:
+                self.last_error = f"{type(e).__name__}: {e}"[:200]
+
+    def stats(self) -> dict:
+        with self._lock:
+            # Closed sessions wait for the next reaper pass to be dropped; they count as neither
+            open_sessions = [session_id for session_id in self._sessions if self.session_exists(session_id)]
+            paths = [self._path(session_id) for session_id in open_sessions if session_id in self._hibernated]
+            stats = {
+                "active_sessions": len(open_sessions) - len(paths),
+                "hibernated_sessions": len(paths),
+                "hibernations": self.hibernations,
+                "rehydrations": self.rehydrations,
+                "idle_seconds": self.idle_seconds,
+                "last_error": self.last_error,
+            }
+        stats["snapshot_kib"] = round(sum(os.path.getsize(path) for path in paths if os.path.exists(path)) / 1024, 1)
+        return stats
+
+
+def streamlit_session_exists(session_id) -> bool:
+    """Whether Streamlit still holds a session, connected or within server.disconnectedSessionTTL"""
+    if not st.runtime.exists():
+        return True
+    return st.runtime.get_instance()._session_mgr.get_session_info(session_id) is not None
+
+
+@st.cache_resource
+def get_hibernator() -> SessionHibernator:
+    hibernator = SessionHibernator(
+        directory=get_setting("LOREWEAVER_HIBERNATE_DIR", "data/hibernated"),
+        idle_seconds=float(get_setting("LOREWEAVER_HIBERNATE_AFTER", 900)),
+        interval=float(get_setting("LOREWEAVER_HIBERNATE_INTERVAL", 60)),
+        retention_seconds=float(get_setting("LOREWEAVER_HIBERNATE_RETENTION", 86400)),
+        turn_coordinator=get_turn_coordinator(),
+        session_exists=streamlit_session_exists,
+    )
+    if hibernator.idle_seconds > 0:
+        hibernator.start()
+    return hibernator
+
+
+def rehydrate_session():
+    """Record activity for this session and restore its state if it was hibernated"""
+    ctx = get_script_run_ctx()
+    if ctx is None:
+        return
+    try:
+        get_hibernator().touch(ctx.session_id, ctx.session_state)
+    except (OSError, ValueError) as e:
+        st.warning(f"Your previous session could not be restored: {str(e)}")
 
 
 # ---------------------------  Session Management  ----------------------------
@@ -680,27 +1809,14 @@ def generate_session_summary():
         return
     
     try:
-        genai.configure(api_key=st.secrets["GOOGLE_API_KEY"])
-        model = genai.GenerativeModel("gemini-1.5-flash-latest") # Use a faster model for summaries
-
         recent_messages = st.session_state.messages[-6:]
         story_content = "\n\n".join([m["content"] for m in recent_messages if m["role"] in ["user", "assistant"]])
         
-        summary_prompt = f"""
-        Create a brief, engaging summary (2-3 sentences) of the recent adventure events:
-        
-        {story_content}
-        
-        Focus on key actions, discoveries, and character development. Write in past tense.
-        """
-        
-        response = model.generate_content(
-            summary_prompt,
-            generation_config={"temperature": 0.7, "max_output_tokens": 150}
-        )
-        
-        summary = response.text
+        # Summaries from concurrent sessions are batched into shared requests
+        with timed_phase("summary_call"):
+            summary = get_summary_aggregator().summarize(story_content)
         st.session_state.session_summaries.append(summary)
+        index_entry("summary", summary)
         st.success("Session summary generated!")
         
     except Exception as e:
@@ -726,44 +1842,370 @@ def export_adventure():
             export_content += f"YOUR CHOICE: {message['content']}\n\n"
     st.download_button(label="📥 Download Adventure Log", data=export_content, file_name=f"adventure_{character['name']}_{datetime.now().strftime('%Y%m%d_%H%M')}.txt", mime="text/plain")
 
+# ---------------------------  On-Demand Profiling  ---------------------------
+# Admins can profile whole reruns or call_ai() turns from the admin panel: the
+# next N matching runs, or a sampled fraction, optionally for one player or
+# session only. Each capture is written as a pstats .prof file (viewable with
+# snakeviz or flameprof) next to a JSON file with its tags and phase timings;
+# only the newest LOREWEAVER_PROFILE_KEEP captures are kept on disk. cProfile
+# can only run in one thread at a time, so runs are skipped while another
+# capture is in progress.
+PROFILE_MODES = ["off", "rerun", "turn"]
+_profile_context = threading.local()
+
+
+@dataclass
+class ProfileCapture:
+    kind: str
+    session_id: str
+    player_id: str
+    started: float
+    profiler: cProfile.Profile
+    phases: dict = field(default_factory=lambda: defaultdict(float))
+
+
+class ProfilerControl:
+    """Process-wide profiling switches, changed at runtime from the admin panel"""
+
+    def __init__(self, directory, keep):
+        self.directory = directory
+        self.keep = keep
+        self.mode = "off"
+        self.sample_rate = 0.0
+        self.target = ""
+        self.pending = 0
+        self.last_error = ""
+        self.captures = deque(maxlen=20)
+        self._lock = threading.Lock()
+        self._busy = threading.Lock()
+
+    def request_capture(self, count=1):
+        with self._lock:
+            self.pending += count
+
+    def should_profile(self, kind, session_id, player_id) -> bool:
+        """Claim the profiler if this run should be captured; the caller must call release()"""
+        if self.mode != kind:
+            return False
+        if self.target and self.target not in (session_id, player_id):
+            return False
+        if not self._busy.acquire(blocking=False):
+            return False
+        with self._lock:
+            if self.pending > 0:
+                self.pending -= 1
+                return True
+        if random.random() < self.sample_rate:
+            return True
+        self._busy.release()
+        return False
+
+    def release(self):
+        self._busy.release()
+
+    def save(self, capture, chapter):
+        elapsed = time.perf_counter() - capture.started
+        os.makedirs(self.directory, exist_ok=True)
+        name = f"{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}_{capture.session_id[:8]}_ch{chapter}_{capture.kind}"
+        base = os.path.join(self.directory, name)
+        capture.profiler.dump_stats(base + ".prof")
+        summary = {
+            "kind": capture.kind,
+            "session_id": capture.session_id,
+            "player_id": capture.player_id,
+            "chapter": chapter,
+            "seconds": round(elapsed, 4),
+            "phases": {phase: round(seconds, 4) for phase, seconds in capture.phases.items()},
+            "profile": base + ".prof",
+        }
+        with open(base + ".json", "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2)
+        with self._lock:
+            self.captures.appendleft(summary)
+        self.prune()
+
+    def prune(self):
+        """Delete the oldest captures beyond the retention limit; names start with their timestamp"""
+        names = sorted(name[:-5] for name in os.listdir(self.directory) if name.endswith(".json"))
+        for name in names[:max(0, len(names) - self.keep)]:
+            for ext in (".prof", ".json"):
+                try:
+                    os.remove(os.path.join(self.directory, name + ext))
+                except FileNotFoundError:
+                    pass
+
+
+@st.cache_resource
+def get_profiler_control() -> ProfilerControl:
+    return ProfilerControl(
+        get_setting("LOREWEAVER_PROFILE_DIR", "data/profiles"),
+        keep=int(get_setting("LOREWEAVER_PROFILE_KEEP", 50)),
+    )
+
+
+@contextmanager
+def profile_scope(kind):
+    """Profile the enclosed code if the admin settings select it; nested scopes are ignored"""
+    control = get_profiler_control()
+    if control.mode == "off" or getattr(_profile_context, "capture", None) is not None:
+        yield
+        return
+    session_id = get_session_id()
+    player_id = st.query_params.get("player", "")
+    if not control.should_profile(kind, session_id, player_id):
+        yield
+        return
+    capture = ProfileCapture(kind, session_id, player_id, time.perf_counter(), cProfile.Profile())
+    try:
+        try:
+            capture.profiler.enable()
+            _profile_context.capture = capture
+        except ValueError as e:
+            # Another profiler outside this app is already active in the interpreter
+            control.last_error = f"{type(e).__name__}: {e}"[:200]
+            capture = None
+        yield
+    finally:
+        if capture is not None:
+            capture.profiler.disable()
+            _profile_context.capture = None
+        control.release()
+        if capture is not None:
+            try:
+                control.save(capture, st.session_state.get("chapter_count", 0))
+            except OSError as e:
+                control.last_error = f"{type(e).__name__}: {e}"[:200]
+
+
+def profiled(kind):
+    """Decorator form of profile_scope()"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with profile_scope(kind):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def timed_phase(name):
+    """Add the enclosed wall time to the active capture's phase breakdown, if any"""
+    capture = getattr(_profile_context, "capture", None)
+    if capture is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        capture.phases[name] += time.perf_counter() - start
+
+
+def render_profiler_controls():
+    # Settings are shared by the whole process, so they are only written when an admin changes a widget
+    control = get_profiler_control()
+    st.selectbox(
+        "Profile", PROFILE_MODES, index=PROFILE_MODES.index(control.mode), key="profiler_mode",
+        on_change=lambda: setattr(control, "mode", st.session_state.profiler_mode),
+        help="rerun: a whole script run; turn: a single call_ai() turn"
+    )
+    st.slider(
+        "Sample rate", 0.0, 1.0, value=control.sample_rate, step=0.01, key="profiler_sample_rate",
+        on_change=lambda: setattr(control, "sample_rate", st.session_state.profiler_sample_rate)
+    )
+    st.text_input(
+        "Only player or session ID", value=control.target, key="profiler_target",
+        on_change=lambda: setattr(control, "target", st.session_state.profiler_target.strip())
+    )
+    if st.button("🎯 Capture next run", key="profiler_capture"):
+        control.request_capture()
+    st.caption(f"{control.pending} capture(s) pending · this session: {get_session_id()}")
+    if control.last_error:
+        st.caption(control.last_error)
+    for capture in list(control.captures):
+        phases = ", ".join(f"{phase} {seconds:.3f}s" for phase, seconds in capture["phases"].items())
+        st.markdown(f"**{capture['kind']}** ch{capture['chapter']} · {capture['seconds']:.3f}s · `{capture['session_id'][:8]}`")
+        st.caption(f"{phases or 'no phases recorded'} → {capture['profile']}")
+
+
+# ---------------------------  Turn Submission  -------------------------------
+# Moves are submitted with the turn ID (chapter count) they were chosen on. Only
+# the first submission for a turn reaches the model; duplicates from racing
+# reruns wait for its reply, and stale turns are rejected. Exactly one submission
+# records the chapter: normally the first, but with fast reruns Streamlit stops
+# the superseded run at its next session-state access, so a waiter records the
+# reply when the first run ended before it could. Choice buttons hand their turn
+# ID to a callback, which Streamlit still runs for a button from the previous
+# page, so a double click on an already answered chapter is counted as stale.
+@dataclass
+class TurnEntry:
+    adventure_id: str
+    turn_id: int
+    move: str
+    future: Future
+    recorded: bool = False
+    record_lock: threading.Lock = field(default_factory=threading.Lock)
+
+
+class TurnCoordinator:
+    """Per-session turn locks shared by all reruns in this process"""
+
+    def __init__(self):
+        self.model_calls = 0
+        self.coalesced = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+        self._turns = {}
+
+    def submit(self, session_id, adventure_id, turn_id, move, generate):
+        """Run generate() once per turn; returns (entry, owner) once the reply is ready, or None for a stale turn
+
+        owner is False for a duplicate that reused another submission's reply; the
+        move that reply answers is entry.move.
+        """
+        while True:
+            with self._lock:
+                entry = self._turns.get(session_id)
+                if entry is not None and entry.adventure_id == adventure_id and turn_id < entry.turn_id:
+                    self.rejected += 1
+                    return None
+                owner = entry is None or entry.adventure_id != adventure_id or turn_id > entry.turn_id
+                if owner:
+                    entry = TurnEntry(adventure_id, turn_id, move, Future())
+                    self._turns[session_id] = entry
+                    self.model_calls += 1
+            if owner:
+                break
+            # Wait outside the lock so other sessions can still submit
+            wait([entry.future])
+            if entry.future.exception() is None:
+                with self._lock:
+                    self.coalesced += 1
+                return entry, False
+            # The first submission failed and was forgotten; take the turn over
+        try:
+            entry.future.set_result(generate())
+        except BaseException as e:  # includes Streamlit's rerun/stop signals, so waiters never hang
+            entry.future.set_exception(e)
+            # Failed turns may be retried
+            with self._lock:
+                if self._turns.get(session_id) is entry:
+                    del self._turns[session_id]
+            raise
+        return entry, True
+
+    @contextmanager
+    def recording(self, session_id, entry):
+        """Let one submission at a time record a finished turn; yields False once it has been recorded
+
+        If the body is interrupted, the turn stays unrecorded for the next submission.
+        """
+        with entry.record_lock:
+            yield not entry.recorded
+            entry.recorded = True
+        # Later clicks on a recorded turn fail call_ai()'s turn check, so its entry can go
+        with self._lock:
+            if self._turns.get(session_id) is entry:
+                del self._turns[session_id]
+
+    def reject(self):
+        with self._lock:
+            self.rejected += 1
+
+    def forget(self, session_id):
+        with self._lock:
+            self._turns.pop(session_id, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "model_calls": self.model_calls,
+                "coalesced_duplicates": self.coalesced,
+                "rejected_stale": self.rejected,
+                "calls_saved": self.coalesced + self.rejected,
+            }
+
+
+@st.cache_resource
+def get_turn_coordinator() -> TurnCoordinator:
+    return TurnCoordinator()
+
+
+def get_session_id() -> str:
+    ctx = get_script_run_ctx()
+    return ctx.session_id if ctx else "local"
+
+
 # ---------------------------  Enhanced AI Integration  -----------------------
 # MODIFIED: This function is completely rewritten for Gemini
-def call_ai(user_move: str) -> str:
-    """Enhanced AI call using Google Gemini."""
+@profiled("turn")
+def call_ai(user_move: str, turn_id: Optional[int] = None) -> str:
+    """Enhanced AI call using Google Gemini.
+
+    turn_id is the chapter count the move was chosen on; it defaults to the current one.
+    """
     if not st.session_state.gemini_model:
         st.error("❌ Gemini model not initialized. Please start a new game.")
         return "The story cannot continue. Please start a new game."
 
+    coordinator = get_turn_coordinator()
+    if turn_id is None:
+        turn_id = st.session_state.chapter_count
+    if turn_id != st.session_state.chapter_count:
+        # This move was chosen on a chapter that has since been answered
+        coordinator.reject()
+        return st.session_state.messages[-1]["content"]
+
     try:
         st.write(f"🔧 Debug: Calling AI with move: {user_move[:50]}...")
         
-        # Append the new user move to the history
-        st.session_state.messages.append({"role": "user", "content": user_move})
+        # The hidden opening prompt stays in messages until its chapter is recorded, so a stopped run is retried
+        held_move = {"role": "user", "content": user_move}
+        history = st.session_state.messages
+        if history[-1:] == [held_move]:
+            history = history[:-1]
 
         # Reformat history for Gemini API: role 'assistant' becomes 'model'
-        history_for_gemini = []
-        for msg in st.session_state.messages:
-            role = "model" if msg["role"] == "assistant" else "user"
-            history_for_gemini.append({"role": role, "parts": [msg["content"]]})
+        with timed_phase("prompt_construction"):
+            history_for_gemini = []
+            for msg in history:
+                role = "model" if msg["role"] == "assistant" else "user"
+                history_for_gemini.append({"role": role, "parts": [msg["content"]]})
+            # Remind the model of the tracked state instead of relying on it to recall the whole transcript
+            history_for_gemini.append({"role": "user", "parts": [f"{user_move}\n\n{format_state_block()}"]})
 
         st.write(f"🔧 Debug: History length: {len(history_for_gemini)}")
 
-        # Start a chat session from the model
-        chat = st.session_state.gemini_model.start_chat(history=history_for_gemini[:-1])
-        
-        # Send the latest user message
+        # Send the full history, ending with the latest user message
         st.write("🔧 Debug: Sending message to Gemini...")
-        response = chat.send_message(history_for_gemini[-1]['parts'][0])
-        
-        reply = response.text
+        kind = "opening" if st.session_state.chapter_count == 0 else "chapter"
+        max_continuations = LENGTH_PROFILES[st.session_state.length_profile]["max_continuations"]
+        model = st.session_state.gemini_model
+        with timed_phase("model_call"):
+            outcome = coordinator.submit(
+                get_session_id(),
+                st.session_state.adventure_id,
+                turn_id,
+                user_move,
+                lambda: generate_chapter(model, history_for_gemini, kind, max_continuations),
+            )
+        if outcome is None:
+            return st.session_state.messages[-1]["content"]
+        entry, owner = outcome
+        if not owner:
+            st.write("🔧 Debug: Reusing the reply of an earlier submission for this turn")
+
+        with coordinator.recording(get_session_id(), entry) as unrecorded:
+            if not unrecorded or st.session_state.chapter_count != turn_id:
+                # Another submission already recorded this chapter
+                return st.session_state.messages[-1]["content"]
+            # Append the move and AI's response to our internal message history
+            if st.session_state.messages[-1:] != [{"role": "user", "content": entry.move}]:
+                st.session_state.messages.append({"role": "user", "content": entry.move})
+            reply = commit_chapter(entry.move, entry.future.result().text)
         st.write(f"🔧 Debug: Received response: {reply[:100]}...")
         
-        # Append AI's response to our internal message history
-        st.session_state.messages.append({"role": "assistant", "content": reply})
-        
-        st.session_state.chapter_count += 1
-        st.session_state.game_history.append(user_move)
-        
         if st.session_state.chapter_count % 5 == 0:
             generate_session_summary()
         
@@ -781,8 +2223,8 @@ def call_ai(user_move: str) -> str:
         elif "model" in str(e).lower():
             st.error("❌ Model error. The model might be unavailable.")
         
-        # Remove the user message that caused the error to allow retrying
-        if st.session_state.messages and st.session_state.messages[-1]["role"] == "user":
+        # Remove the user message that caused the error to allow retrying; the held opening prompt stays for the retry
+        if st.session_state.chapter_count > 0 and st.session_state.messages and st.session_state.messages[-1]["role"] == "user":
             st.session_state.messages.pop()
         
         return "The mystical forces of creation seem to be disrupted. Perhaps try a different action or rephrase your choice."
@@ -806,6 +2248,80 @@ def extract_choices(text):
                     choices.append(choice_text)
     return choices[:4]
 
+# ---------------------------  Game State Engine  -----------------------------
+# Each chapter is scanned once for health and inventory changes, preferring the
+# [STATE: ...] tag requested in the system prompt. Without a tag, only explicit
+# numeric damage or healing in the prose is applied; the inventory is left alone
+# because bolded prose is far too noisy to read items from. Applying a delta
+# touches only health and inventory.
+# The tag may appear inline (e.g. after the last choice) and wrapped in Markdown.
+STATE_TAG_PATTERN = re.compile(r"[ \t]*[`*_]*\[STATE:\s*([^\]]*)\][`*_]*", re.IGNORECASE)
+STATE_RULES = {
+    "damage": re.compile(r"\b(?:take|takes|took|suffer|suffers|suffered|lose|loses|lost)\s+(\d+)\s+(?:points?\s+of\s+)?(?:damage|health|hp)\b", re.IGNORECASE),
+    "healing": re.compile(r"\b(?:heal|heals|healed|regain|regains|regained|recover|recovers|recovered|restore|restores|restored)\s+(\d+)\s+(?:points?\s+of\s+)?(?:health|hp)\b", re.IGNORECASE),
+}
+CHOICE_LINE_PATTERN = re.compile(r"^\s*\d+[\.)].*$", re.MULTILINE)
+
+
+@dataclass
+class StateDelta:
+    health: int = 0
+    gained: list = field(default_factory=list)
+    lost: list = field(default_factory=list)
+
+
+def parse_state_tag(body) -> StateDelta:
+    """Parse the contents of a [STATE: ...] tag"""
+    delta = StateDelta()
+    for clause in body.split(";"):
+        clause = clause.strip()
+        health = re.match(r"(?:health|hp)\s*([+-]?\s*\d+)", clause, re.IGNORECASE)
+        if health:
+            delta.health += int(health.group(1).replace(" ", ""))
+        elif clause.lower().startswith("gained "):
+            delta.gained.extend(item.strip(" *_`") for item in clause[7:].split(",") if item.strip(" *_`"))
+        elif clause.lower().startswith("lost "):
+            delta.lost.extend(item.strip(" *_`") for item in clause[5:].split(",") if item.strip(" *_`"))
+    return delta
+
+
+def extract_state_delta(text):
+    """Strip the state tag from a chapter and return (clean_text, delta)"""
+    tags = STATE_TAG_PATTERN.findall(text)
+    clean_text = STATE_TAG_PATTERN.sub("", text).rstrip() if tags else text.rstrip()
+    if tags:
+        delta = StateDelta()
+        for body in tags:
+            tag_delta = parse_state_tag(body)
+            delta.health += tag_delta.health
+            delta.gained.extend(tag_delta.gained)
+            delta.lost.extend(tag_delta.lost)
+        return clean_text, delta
+    prose = CHOICE_LINE_PATTERN.sub("", clean_text)
+    return clean_text, StateDelta(
+        health=sum(int(n) for n in STATE_RULES["healing"].findall(prose)) - sum(int(n) for n in STATE_RULES["damage"].findall(prose)),
+    )
+
+
+def apply_state_delta(delta):
+    """Apply a chapter's changes to health and inventory"""
+    st.session_state.health = max(0, min(100, st.session_state.health + delta.health))
+    inventory = st.session_state.inventory
+    for item in delta.lost:
+        held = next((i for i in inventory if i.lower() == item.lower()), None)
+        if held is not None:
+            inventory.remove(held)
+    for item in delta.gained:
+        if all(i.lower() != item.lower() for i in inventory):
+            inventory.append(item)
+
+
+def format_state_block() -> str:
+    """Short summary of the tracked state, sent with each move"""
+    inventory = ", ".join(st.session_state.inventory) if st.session_state.inventory else "Empty"
+    return f"[CURRENT STATE: Health {st.session_state.health}/100; Inventory: {inventory}]"
+
+
 # ---------------------------  Main Game Interface  ---------------------------
 # (No major changes needed, just logic flow adjustments)
 def main_game():
@@ -838,15 +2354,14 @@ def main_game():
         st.write("🔧 Debug: Generating first story response...")
         # First turn after initialization
         with st.spinner("🎭 Beginning your epic adventure with Gemini..."):
-            initial_prompt = st.session_state.messages[0]['content']
-            # We pop the user message so call_ai can add it back correctly
-            st.session_state.messages.pop() 
-            response = call_ai(initial_prompt)
-            
-            if response == "The story cannot continue. Please start a new game.":
-                st.error("❌ Failed to start adventure. Check your API key and try again.")
-                return
-                
+            # The prompt stays in messages until call_ai records the opening chapter
+            call_ai(st.session_state.messages[0]['content'])
+
+        if st.session_state.chapter_count == 0:
+            # The opening prompt is still in messages, so the next rerun retries it
+            st.error("❌ Failed to start adventure. Check your API key and try again.")
+            st.button("🔄 Retry Opening Chapter", key="retry_opening")
+            return
         st.rerun()
         return
     
@@ -861,32 +2376,38 @@ def main_game():
         return
     
     # Display game messages
-    chapter_num = 1
-    for i, message in enumerate(st.session_state.messages):
-        if message["role"] == "assistant":
-            st.markdown(f'<div class="story-content">', unsafe_allow_html=True)
-            st.markdown(f"### 📖 Chapter {chapter_num}")
-            st.markdown(message["content"])
-            st.markdown('</div>', unsafe_allow_html=True)
-            chapter_num += 1
-        elif message["role"] == "user" and chapter_num > 1: # Don't show the initial hidden prompt
-             st.markdown(f"**🎯 You chose:** *{message['content']}*")
+    with timed_phase("chapter_loop"):
+        chapter_num = 1
+        for i, message in enumerate(st.session_state.messages):
+            if message["role"] == "assistant":
+                st.markdown(f'<div class="story-content">', unsafe_allow_html=True)
+                st.markdown(f"### 📖 Chapter {chapter_num}")
+                st.markdown(message["content"])
+                st.markdown('</div>', unsafe_allow_html=True)
+                chapter_num += 1
+            elif message["role"] == "user" and chapter_num > 1: # Don't show the initial hidden prompt
+                 st.markdown(f"**🎯 You chose:** *{message['content']}*")
 
     # Handle user input
     if st.session_state.gemini_model and len(st.session_state.messages) > 0:
         last_message = st.session_state.messages[-1]
         if last_message["role"] == "assistant":
-            choices = extract_choices(last_message["content"])
+            with timed_phase("extract_choices"):
+                choices = extract_choices(last_message["content"])
             if choices:
                 st.markdown("### 🎯 What do you do next?")
                 cols = st.columns(min(len(choices), 2))
+                # Buttons queue their move with the turn it was chosen on; it runs below, once every button is registered
+                turn_id = st.session_state.chapter_count
                 for i, choice in enumerate(choices):
                     with cols[i % 2]:
-                        if st.button(choice, key=f"choice_{i}", use_container_width=True):
-                            st.session_state.last_choice = choice
-                            with st.spinner("🎭 Weaving the next chapter of your tale..."):
-                                call_ai(choice)
-                            st.rerun()
+                        st.button(
+                            choice,
+                            key=f"choice_{turn_id}_{i}",
+                            use_container_width=True,
+                            on_click=queue_move,
+                            args=(choice, turn_id, "🎭 Weaving the next chapter of your tale..."),
+                        )
             st.markdown("---")
             st.markdown("### ✨ Custom Action")
             if "custom_input_value" not in st.session_state: 
@@ -902,15 +2423,29 @@ def main_game():
             )
             col1, col2 = st.columns([3, 1])
             with col2:
-                if st.button("🎲 Take Action", key="custom_action_btn"):
-                    if custom_action and custom_action.strip():
-                        st.session_state.last_choice = custom_action
-                        st.session_state.custom_input_value = ""
-                        with st.spinner("🎭 Adapting to your creative choice..."):
-                            call_ai(custom_action)
-                        st.rerun()
-                    else: 
+                turn_id = st.session_state.chapter_count
+                if st.button("🎲 Take Action", key=f"custom_action_btn_{turn_id}", on_click=queue_custom_action, args=(turn_id,)):
+                    if not (custom_action and custom_action.strip()):
                         st.warning("Please enter an action first!")
+
+            if st.session_state.pending_move:
+                move, move_turn_id, spinner_text = st.session_state.pending_move
+                st.session_state.pending_move = None
+                with st.spinner(spinner_text):
+                    call_ai(move, move_turn_id)
+                st.rerun()
+
+def queue_move(move, turn_id, spinner_text):
+    """Button callback: remember the move and the turn it was chosen on for this rerun"""
+    st.session_state.last_choice = move
+    st.session_state.pending_move = (move, turn_id, spinner_text)
+
+def queue_custom_action(turn_id):
+    custom_action = st.session_state.get("custom_input_field", "")
+    if custom_action and custom_action.strip():
+        st.session_state.custom_input_value = ""
+        queue_move(custom_action, turn_id, "🎭 Adapting to your creative choice...")
+
 # (No changes needed in get_genre_action_placeholder)
 def get_genre_action_placeholder(genre):
     placeholders = { "🏰 Epic Fantasy": "e.g., attempt to commune with the ancient spirits, challenge the dark lord to single combat, seek the blessing of the forest guardians", "🌑 Dark Fantasy": "e.g., make a deal with the shadowy figure, investigate the source of the corruption, sacrifice something precious for power", "👻 Horror": "e.g., carefully investigate the strange noise, barricade the door and wait, try to contact the outside world", "🚀 Sci-Fi Adventure": "e.g., scan the area with your tricorder, attempt to establish communication, analyze the alien technology", "🤖 Cyberpunk": "e.g., hack into the corporate mainframe, contact your underground connections, jack into the matrix", "😂 Comedy Adventure": "e.g., try an absurdly complicated plan, make a terrible pun to defuse tension, accidentally solve everything", "🕵️ Mystery/Detective": "e.g., examine the crime scene for clues, question the suspicious witness, check the alibis", "💖 Romance Adventure": "e.g., have a heartfelt conversation, plan a romantic gesture, address the relationship tension" }
@@ -918,5 +2453,9 @@ def get_genre_action_placeholder(genre):
 
 # ---------------------------  App Entry Point  -------------------------------
 if __name__ == "__main__":
-    render_sidebar()
-    main_game()
\ No newline at end of file
+    with profile_scope("rerun"):
+        rehydrate_session()  # must run before defaults are filled in
+        initialize_session_state()
+        get_warm_pool()  # starts the background filler once per process
+        render_sidebar()
+        main_game()
\ No newline at end of file
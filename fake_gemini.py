@@ -0,0 +1,176 @@
+"""Local stand-in for the Gemini REST API, for testing LoreWeaver offline.
+
+Run it and point the app at it:
+
+    python fake_gemini.py --port 8765 --latency 1.5 --bad-keys revoked-key --quota-keys busy-key
+    GEMINI_API_ENDPOINT=http://localhost:8765 GOOGLE_API_KEYS=good-key,revoked-key,busy-key streamlit run app.py
+
+Keys listed in --bad-keys get 403 PERMISSION_DENIED and keys in --quota-keys get
+429 RESOURCE_EXHAUSTED, which exercises the key pool's quarantine and recovery.
+Replies honour maxOutputTokens and report MAX_TOKENS when a chapter is cut off.
+"""
+
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PATH_PATTERN = re.compile(r"^/v1beta/models/(?P<model>[^:/]+):generateContent")
+BATCH_ITEM_PATTERN = re.compile(r"^\s*### ADVENTURE \d+", re.MULTILINE)
+
+SCENES = [
+    "The air is thick with the smell of rain and old stone.",
+    "Somewhere in the distance, a bell tolls three times and falls silent.",
+    "You feel the weight of countless eyes watching from the shadows.",
+    "A narrow path winds ahead, lit by flickering lanterns.",
+    "Your footsteps echo far longer than they should.",
+    "A stranger in a **weathered cloak** studies you without a word.",
+    "*Something ancient stirs beneath your feet.*",
+    "The wind carries a whisper that sounds almost like your name.",
+]
+ACTIONS = [
+    "Follow the narrow path deeper into the unknown",
+    "Question the stranger about what they have seen",
+    "Search the area carefully for hidden clues",
+    "Turn back and look for another way forward",
+    "Light a torch and investigate the strange sound",
+]
+STATE_TAGS = [
+    "[STATE: none]",
+    "[STATE: health -10]",
+    "[STATE: health +5]",
+    "[STATE: gained Old Lantern]",
+    "[STATE: health -5; gained Rusty Key]",
+]
+
+
+def estimate_tokens(text):
+    return max(1, int(len(text.split()) * 1.4))
+
+
+def fake_chapter(rng, words):
+    """Build a chapter of roughly `words` words that ends with numbered choices and a state tag"""
+    paragraphs = []
+    count = 0
+    while count < words:
+        sentences = [rng.choice(SCENES) for _ in range(5)]
+        paragraphs.append(" ".join(sentences))
+        count += sum(len(s.split()) for s in sentences)
+    choices = rng.sample(ACTIONS, 3)
+    choice_lines = "\n".join(f"{i}. {choice}" for i, choice in enumerate(choices, 1))
+    return "\n\n".join(paragraphs) + "\n\n" + choice_lines + "\n" + rng.choice(STATE_TAGS)
+
+
+def fake_summary(rng, prompt):
+    """Summarize one adventure, or each adventure of a batched summary request"""
+    items = len(BATCH_ITEM_PATTERN.findall(prompt))
+    if not items:
+        return "You " + rng.choice(ACTIONS).lower() + ", uncovering new secrets along the way."
+    return "\n".join(f"### SUMMARY {i}\n{fake_summary(rng, '')}" for i in range(1, items + 1))
+
+
+class FakeGeminiServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.5, jitter=0.0, words=250, bad_keys=(), quota_keys=()):
+        super().__init__(address, FakeGeminiHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.words = words
+        self.bad_keys = set(bad_keys)
+        self.quota_keys = set(quota_keys)
+        self.requests_by_key = Counter()
+        self.lock = threading.Lock()
+
+    def build_reply(self, model, body):
+        rng = random.Random(hashlib.sha256(json.dumps(body, sort_keys=True).encode("utf-8")).hexdigest())
+        if "flash" in model:
+            last_turn = body.get("contents", [{}])[-1]
+            text = fake_summary(rng, "".join(part.get("text", "") for part in last_turn.get("parts", [])))
+        else:
+            text = fake_chapter(rng, self.words)
+        finish_reason = "STOP"
+        max_tokens = body.get("generationConfig", {}).get("maxOutputTokens")
+        if max_tokens and estimate_tokens(text) > max_tokens:
+            text = " ".join(text.split(" ")[: int(max_tokens / 1.4)])
+            finish_reason = "MAX_TOKENS"
+        return {
+            "candidates": [{"content": {"parts": [{"text": text}], "role": "model"}, "finishReason": finish_reason, "index": 0}],
+            "usageMetadata": {"candidatesTokenCount": estimate_tokens(text)},
+        }
+
+
+class FakeGeminiHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, payload):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_error_status(self, code, status, message):
+        self.send_json(code, {"error": {"code": code, "message": message, "status": status}})
+
+    def do_POST(self):
+        match = PATH_PATTERN.match(self.path)
+        if not match:
+            self.send_error_status(404, "NOT_FOUND", f"Unknown path {self.path}")
+            return
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        api_key = self.headers.get("x-goog-api-key", "")
+        server = self.server
+        with server.lock:
+            server.requests_by_key[api_key] += 1
+        if api_key in server.bad_keys:
+            self.send_error_status(403, "PERMISSION_DENIED", "API key not valid. Please pass a valid API key.")
+            return
+        if api_key in server.quota_keys:
+            self.send_error_status(429, "RESOURCE_EXHAUSTED", "Resource has been exhausted (e.g. check quota).")
+            return
+        time.sleep(max(0.0, server.latency + random.uniform(-server.jitter, server.jitter)))
+        self.send_json(200, server.build_reply(match.group("model"), body))
+
+
+def start_server(host="127.0.0.1", port=8765, **options) -> FakeGeminiServer:
+    """Start a fake Gemini server on a background thread"""
+    server = FakeGeminiServer((host, port), **options)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.5, help="seconds to wait before each reply")
+    parser.add_argument("--jitter", type=float, default=0.0, help="random +/- seconds added to the latency")
+    parser.add_argument("--words", type=int, default=250, help="approximate words per chapter")
+    parser.add_argument("--bad-keys", default="", help="comma-separated keys rejected with 403")
+    parser.add_argument("--quota-keys", default="", help="comma-separated keys rejected with 429")
+    args = parser.parse_args()
+    server = FakeGeminiServer(
+        (args.host, args.port),
+        latency=args.latency,
+        jitter=args.jitter,
+        words=args.words,
+        bad_keys=[k for k in args.bad_keys.split(",") if k],
+        quota_keys=[k for k in args.quota_keys.split(",") if k],
+    )
+    print(f"Fake Gemini listening on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
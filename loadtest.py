@@ -0,0 +1,320 @@
+"""Concurrent-session load test for LoreWeaver.
+
+Starts app.py under a real `streamlit run` server and connects N simulated
+players to it over the same websocket protocol a browser tab uses. Each player
+goes through character creation, genre selection, a standard adventure and
+repeated choices. Model calls go to fake_gemini.py with a configurable latency,
+so no real quota is used. The app's search index, session snapshots and
+profiles go to a temporary directory that is removed after the run.
+
+    python loadtest.py --sessions 1,2,4,8,16 --turns 5 --latency 1.0
+
+For each concurrency level it reports:
+
+- throughput: turns finished per second across all sessions of the level
+- p50/p95/p99: seconds from a click to the end of the script run it caused,
+  including any st.rerun() the app makes on its own
+- RSS change: growth of the server process's resident memory over the level,
+  sampled while every session of the level is still connected, in total and
+  per session
+
+It then names the level at which the server saturated.
+
+With --bad-keys, those keys are added to the app's key pool and the fake model
+rejects them with 403, as it does for a revoked key. The run then fails unless
+the key pool quarantined them after their first failures.
+"""
+
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from dataclasses import dataclass, field
+
+from streamlit.proto.Alert_pb2 import Alert
+from streamlit.proto.BackMsg_pb2 import BackMsg
+from streamlit.proto.ForwardMsg_pb2 import ForwardMsg
+from websockets.asyncio.client import connect
+
+import fake_gemini
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+
+
+class StreamlitClient:
+    """One browser tab talking to a Streamlit server over its websocket"""
+
+    def __init__(self, base_url, timeout):
+        self.base_url = base_url
+        self.timeout = timeout
+        self.connection = None
+        self.widget_values = {}
+        self.elements = []
+
+    async def connect(self):
+        ws_url = self.base_url.replace("http", "ws", 1) + "/_stcore/stream"
+        self.connection = await connect(ws_url, subprotocols=["streamlit"], max_size=None)
+
+    async def close(self):
+        if self.connection is not None:
+            await self.connection.close()
+            self.connection = None
+
+    async def run(self, trigger=None, **values):
+        """Rerun the script with the given widget values and an optional button click, then wait for it to finish
+
+        The client never reports cached messages, so the server sends every element in full.
+        """
+        self.widget_values.update(values)
+        msg = BackMsg()
+        msg.rerun_script.query_string = ""
+        for widget_id, value in self.widget_values.items():
+            state = msg.rerun_script.widget_states.widgets.add()
+            state.id = widget_id
+            state.string_value = value
+        if trigger is not None:
+            state = msg.rerun_script.widget_states.widgets.add()
+            state.id = trigger
+            state.trigger_value = True
+        await self.connection.send(msg.SerializeToString())
+
+        self.elements = []
+        while True:
+            reply = ForwardMsg()
+            reply.ParseFromString(await asyncio.wait_for(self.connection.recv(), self.timeout))
+            kind = reply.WhichOneof("type")
+            if kind == "new_session":
+                # Every script run, including ones started by st.rerun(), redraws the page
+                self.elements = []
+            elif kind == "delta" and reply.delta.WhichOneof("type") == "new_element":
+                self.elements.append(reply.delta.new_element)
+            elif kind == "script_finished" and reply.script_finished != ForwardMsg.FINISHED_EARLY_FOR_RERUN:
+                return
+
+    def widgets(self, kind):
+        return [getattr(e, kind) for e in self.elements if e.WhichOneof("type") == kind]
+
+    def find_button(self, label=None, key_prefix=None):
+        for button in self.widgets("button"):
+            if label is not None and button.label == label:
+                return button.id
+            # Widget IDs end with the user key: "<prefix>-<hash>-<key>"
+            if key_prefix is not None and button.id.split("-", 2)[-1].startswith(key_prefix):
+                return button.id
+        raise LookupError(f"No button {label or key_prefix!r} on the page")
+
+    def find_text_input(self, label):
+        for text_input in self.widgets("text_input"):
+            if text_input.label == label:
+                return text_input.id
+        raise LookupError(f"No text input {label!r} on the page")
+
+    def check_page(self):
+        for exception in self.widgets("exception"):
+            raise RuntimeError(f"{exception.type}: {exception.message}")
+        errors = [a.body for a in self.widgets("alert") if a.format == Alert.ERROR and a.body.startswith("❌")]
+        if errors:
+            raise RuntimeError(errors[0])
+
+
+@dataclass
+class SessionResult:
+    client: StreamlitClient
+    turn_latencies: list = field(default_factory=list)
+    error: str = ""
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def read_rss_mib(pid):
+    """Current resident memory of a process, from /proc (Linux only)"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return 0.0
+
+
+async def timed_run(client, widget_id, result):
+    start = time.perf_counter()
+    await client.run(trigger=widget_id)
+    result.turn_latencies.append(time.perf_counter() - start)
+    client.check_page()
+
+
+async def play_session(base_url, index, turns, timeout) -> SessionResult:
+    """Play one adventure from character creation through `turns` choices, leaving the session connected"""
+    result = SessionResult(StreamlitClient(base_url, timeout))
+    client = result.client
+    try:
+        await client.connect()
+        await client.run()
+        name_input = client.find_text_input("Character Name")
+        await client.run(trigger=client.find_button(key_prefix="create_char"), **{name_input: f"Tester {index}"})
+        await client.run(trigger=client.find_button(key_prefix="select_genre_"))
+        await client.run(trigger=client.find_button(label="🎯 Choose Standard Adventure"))
+        client.check_page()
+        # Starting the adventure generates the opening chapter
+        await timed_run(client, client.find_button(key_prefix="start_"), result)
+        for _ in range(turns):
+            await timed_run(client, client.find_button(key_prefix="choice_"), result)
+    except Exception as e:
+        result.error = f"{type(e).__name__}: {e}"
+    return result
+
+
+async def run_level(base_url, server_pid, sessions, turns, timeout) -> dict:
+    rss_before = read_rss_mib(server_pid)
+    start = time.perf_counter()
+    results = await asyncio.gather(*(play_session(base_url, i, turns, timeout) for i in range(sessions)))
+    elapsed = time.perf_counter() - start
+    rss_change = read_rss_mib(server_pid) - rss_before
+    await asyncio.gather(*(r.client.close() for r in results))
+    latencies = [t for r in results for t in r.turn_latencies]
+    return {
+        "sessions": sessions,
+        "turns": len(latencies),
+        "errors": [r.error for r in results if r.error],
+        "elapsed": elapsed,
+        "throughput": len(latencies) / elapsed if elapsed else 0.0,
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "rss_change_mib": rss_change,
+        "rss_per_session_mib": rss_change / sessions,
+    }
+
+
+def find_saturation(levels, min_gain, p95_limit):
+    """Return the first level where throughput stops scaling or p95 latency exceeds the limit"""
+    for previous, level in zip(levels, levels[1:]):
+        if level["throughput"] < previous["throughput"] * (1 + min_gain):
+            return level, f"throughput grew less than {min_gain:.0%} over {previous['sessions']} sessions"
+        if p95_limit and level["p95"] > p95_limit:
+            return level, f"p95 turn latency above {p95_limit:.1f}s"
+    return None, ""
+
+
+def check_quarantine(fake, bad_keys, max_sessions) -> list:
+    """Return the rejected keys that kept taking traffic instead of being quarantined"""
+    # Requests already in flight when a key first fails may still reach it; one per session at most
+    limit = max_sessions
+    leaking = []
+    for key in bad_keys:
+        requests = fake.requests_by_key[key]
+        print(f"Rejected key {key!r}: {requests} request(s), at most {limit} expected before quarantine")
+        if requests > limit:
+            leaking.append(key)
+    return leaking
+
+
+def start_app(port, env, timeout) -> subprocess.Popen:
+    """Start `streamlit run app.py` and wait until it answers its health check"""
+    server = subprocess.Popen(
+        [sys.executable, "-m", "streamlit", "run", APP_PATH,
+         "--server.headless", "true", "--server.port", str(port),
+         "--server.fileWatcherType", "none", "--browser.gatherUsageStats", "false"],
+        env=env, stdout=subprocess.DEVNULL,
+    )
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"streamlit exited with code {server.returncode}")
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/_stcore/health", timeout=1):
+                return server
+        except OSError:
+            time.sleep(0.5)
+    server.terminate()
+    raise RuntimeError(f"streamlit did not become healthy within {timeout:.0f}s")
+
+
+async def run_levels(base_url, server_pid, levels, args):
+    print(f"{'sessions':>8} {'turns':>6} {'errors':>6} {'turns/s':>8} {'p50 s':>7} {'p95 s':>7} {'p99 s':>7} {'RSS Δ MiB':>9} {'MiB/session':>11}")
+    # One unmeasured session first, so imports and model setup don't count against the first level
+    warmup = await play_session(base_url, 0, 0, args.timeout)
+    await warmup.client.close()
+    if warmup.error:
+        print(f"         ! warm-up: {warmup.error}")
+    results = []
+    for sessions in levels:
+        level = await run_level(base_url, server_pid, sessions, args.turns, args.timeout)
+        results.append(level)
+        print(f"{level['sessions']:>8} {level['turns']:>6} {len(level['errors']):>6} {level['throughput']:>8.2f} "
+              f"{level['p50']:>7.2f} {level['p95']:>7.2f} {level['p99']:>7.2f} "
+              f"{level['rss_change_mib']:>9.1f} {level['rss_per_session_mib']:>11.2f}")
+        for error in level["errors"][:3]:
+            print(f"         ! {error}")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent-session load test for LoreWeaver")
+    parser.add_argument("--sessions", default="1,2,4,8,16", help="comma-separated concurrency levels")
+    parser.add_argument("--turns", type=int, default=5, help="choices made by each session after the opening")
+    parser.add_argument("--latency", type=float, default=1.0, help="fake model latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.2, help="fake model latency jitter in seconds")
+    parser.add_argument("--endpoint", help="use an already running fake_gemini.py instead of starting one")
+    parser.add_argument("--port", type=int, default=8765, help="port for the in-process fake model server")
+    parser.add_argument("--app-port", type=int, default=8599, help="port for the streamlit server under test")
+    parser.add_argument("--timeout", type=float, default=120.0, help="seconds allowed per script run")
+    parser.add_argument("--min-gain", type=float, default=0.1, help="throughput gain below which a level counts as saturated")
+    parser.add_argument("--p95-limit", type=float, default=0.0, help="p95 turn latency (s) that counts as saturated")
+    parser.add_argument("--bad-keys", default="", help="comma-separated keys the fake model rejects with 403; checks they get quarantined")
+    args = parser.parse_args()
+
+    bad_keys = [k for k in args.bad_keys.split(",") if k]
+    if bad_keys and args.endpoint:
+        parser.error("--bad-keys needs the in-process fake model server")
+    if args.endpoint:
+        endpoint = args.endpoint
+    else:
+        fake = fake_gemini.start_server(port=args.port, latency=args.latency, jitter=args.jitter, bad_keys=bad_keys)
+        endpoint = f"http://127.0.0.1:{args.port}"
+    env = dict(os.environ, GEMINI_API_ENDPOINT=endpoint)
+    env.setdefault("GOOGLE_API_KEYS", "loadtest-key")
+    if bad_keys:
+        env["GOOGLE_API_KEYS"] = ",".join([env["GOOGLE_API_KEYS"], *bad_keys])
+    env.setdefault("LOREWEAVER_CASSETTE_MODE", "off")
+
+    # Synthetic players must never reach the real search index, snapshots or profiles
+    with tempfile.TemporaryDirectory(prefix="loreweaver-loadtest-") as data_dir:
+        env["LOREWEAVER_SEARCH_DB"] = os.path.join(data_dir, "adventures.db")
+        env["LOREWEAVER_HIBERNATE_DIR"] = os.path.join(data_dir, "hibernated")
+        env["LOREWEAVER_PROFILE_DIR"] = os.path.join(data_dir, "profiles")
+        server = start_app(args.app_port, env, args.timeout)
+        try:
+            print(f"Model backend: {endpoint} (latency {args.latency}s ± {args.jitter}s), app server pid {server.pid}")
+            levels = asyncio.run(run_levels(
+                f"http://127.0.0.1:{args.app_port}", server.pid,
+                [int(n) for n in args.sessions.split(",") if n.strip()], args,
+            ))
+        finally:
+            server.terminate()
+            server.wait()
+
+    saturated, reason = find_saturation(levels, args.min_gain, args.p95_limit)
+    if saturated:
+        print(f"Saturation at {saturated['sessions']} concurrent sessions: {reason}.")
+    else:
+        print("No saturation detected; try higher concurrency levels.")
+
+    if bad_keys and check_quarantine(fake, bad_keys, max(level["sessions"] for level in levels)):
+        sys.exit("Key pool did not quarantine a rejected key.")
+
+
+if __name__ == "__main__":
+    main()